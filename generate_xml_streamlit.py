@@ -1,9 +1,10 @@
 import os
 import sys
-import xml.etree.ElementTree as ET
-import xml.dom.minidom
+import pickle
+from lxml import etree as ET
 import streamlit as st
 import xmlschema
+from xmlschema.validators import XsdElement, XsdGroup
 import yaml
 import re
 import csv
@@ -19,6 +20,9 @@ from sqlalchemy import create_engine
 import copy
 import uuid
 import zipfile
+import functools
+import concurrent.futures
+import threading
 
 # Page configuration
 st.set_page_config(page_title="EUDAMED XML Generator", layout="wide")
@@ -111,31 +115,151 @@ def load_eudamed_metadata():
         
     return metadata, sorted_headers
 
-@st.cache_resource
-def load_schema():
-    """Load and cache the XML schema."""
+def load_pickled_schema(xsd_path):
+    """
+    Load the compiled schema from a pickle next to the XSD, rebuilding it when stale.
+    The cache is considered fresh if it is newer than every .xsd file of the XSD tree
+    and was written by the installed xmlschema version.
+    """
+    cache_path = xsd_path + ".pickle"
+    xsd_root = os.path.dirname(os.path.dirname(xsd_path))
+
+    # Includes/imports live in sibling folders, so check the whole XSD tree
+    newest_xsd_mtime = os.path.getmtime(xsd_path)
+    for dirpath, _, filenames in os.walk(xsd_root):
+        for fname in filenames:
+            if fname.endswith('.xsd'):
+                newest_xsd_mtime = max(newest_xsd_mtime, os.path.getmtime(os.path.join(dirpath, fname)))
+
+    if os.path.exists(cache_path) and newest_xsd_mtime <= os.path.getmtime(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                version, schema, annotations = pickle.load(f)
+            # Pickled components are only valid for the xmlschema release that built them
+            if version != xmlschema.__version__:
+                raise ValueError(f"built with xmlschema {version}, installed {xmlschema.__version__}")
+            for component, annotation in annotations:
+                # Re-fill the cached property (fails here, not at render time, if it stops being one)
+                setattr(component, 'annotation', annotation)
+            return schema
+        except Exception as e:
+            # Corrupt, outdated or foreign cache -> rebuild below
+            print(f"Ignoring schema cache {cache_path}: {e}")
+
+    # All includes/imports are local (W3C schemas come from xmlschema's bundled copies),
+    # so forbid remote fetches and keep build logging quiet
+    schema = xmlschema.XMLSchema(xsd_path, loglevel='ERROR', allow='local')
+    # xmlschema drops cached properties when pickling. Annotations resolved at build time
+    # (e.g. simpleType docs, whose elem is the inner restriction) can't be recomputed
+    # afterwards, so they are stored alongside the schema and restored on load.
+    annotations = [
+        (component, component.__dict__['annotation'])
+        for component in schema.maps.iter_components()
+        if 'annotation' in component.__dict__
+    ]
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((xmlschema.__version__, schema, annotations), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"Could not write schema cache {cache_path}: {e}")
+    return schema
+
+def build_schemas():
+    """
+    Load the XML schema.
+    Returns (schema, lxml_schema, error): xmlschema drives the form introspection,
+    the libxml2-compiled lxml schema validates the generated messages.
+    """
     base_dir = os.path.dirname(os.path.abspath(__file__))
     xsd_path = os.path.join(base_dir, 'EUDAMED downloaded', 'XSD', 'service', 'Message.xsd')
     
     if not os.path.exists(xsd_path):
-        return None, f"Schema file not found at: {xsd_path}"
+        return None, None, f"Schema file not found at: {xsd_path}"
 
     try:
-        schema = xmlschema.XMLSchema(xsd_path)
-        return schema, None
+        schema = load_pickled_schema(xsd_path)
+        lxml_schema = ET.XMLSchema(ET.parse(xsd_path))
+        return schema, lxml_schema, None
     except Exception as e:
-        return None, f"Failed to load schema: {e}"
+        return None, None, f"Failed to load schema: {e}"
+
+@st.cache_resource
+def start_schema_load():
+    """
+    Start building the schemas in a background thread and cache the Future,
+    so the page skeleton can render while the XSD is parsed.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(build_schemas)
+    executor.shutdown(wait=False)
+    return future
+
+def load_schema():
+    """Wait for the background schema build. Returns (schema, lxml_schema, error)."""
+    return start_schema_load().result()
 
+@st.cache_resource
+def get_validation_lock():
+    """
+    Process-wide lock for the shared lxml validator: validate() resets the schema's single
+    error_log and runs without the GIL, so concurrent sessions would mix up their errors.
+    """
+    return threading.Lock()
+
+@st.cache_resource
+def get_introspection_cache():
+    """Process-wide store for schema introspection results, kept across Streamlit reruns."""
+    return {}
+
+introspection_cache = get_introspection_cache()
+
+def memoize_per_component(func):
+    """
+    Memoizes a schema introspection helper by id() of its arguments (XSD components).
+    The arguments are stored next to the result so their ids cannot be reused after GC.
+    """
+    @functools.wraps(func)
+    def wrapper(*objs):
+        key = (func.__name__,) + tuple(id(obj) for obj in objs)
+        entry = introspection_cache.get(key)
+        if entry is None:
+            entry = introspection_cache[key] = (objs, func(*objs))
+        return entry[1]
+    return wrapper
+
+@memoize_per_component
+def get_model_particles(group):
+    """List the direct particles (elements and nested groups) of a model group."""
+    return list(group.iter_model())
+
+@memoize_per_component
+def get_element_names(group):
+    """Local names of the element particles of a model group, in model order."""
+    return tuple(p.local_name for p in group.iter_model() if isinstance(p, XsdElement))
+
+@memoize_per_component
+def get_derived_types(type_obj):
+    """Find the concrete types derived directly from an (abstract) type."""
+    derived_types = []
+    if schema and hasattr(schema, 'maps') and schema.maps:
+        for tname, tdef in schema.maps.types.items():
+            if (hasattr(tdef, 'base_type') and tdef.base_type is type_obj
+                 and not getattr(tdef, 'abstract', False)):
+                derived_types.append(tdef)
+    return derived_types
+
+@memoize_per_component
 def get_enums_for_type(type_obj):
-    """Extract enumeration values from a type object."""
+    """Extract enumeration values from a type object as an immutable, reusable tuple."""
     enums = None
     if type_obj.is_simple():
         if hasattr(type_obj, 'enumeration') and type_obj.enumeration:
             enums = type_obj.enumeration
         elif hasattr(type_obj, 'base_type') and hasattr(type_obj.base_type, 'enumeration') and type_obj.base_type.enumeration:
              enums = type_obj.base_type.enumeration
-    return [str(e) for e in enums] if enums else None
+    return tuple(str(e) for e in enums) if enums else None
 
+@memoize_per_component
 def get_enum_labels(type_obj):
     """Extract human-readable labels for enumeration values from XSD annotations."""
     labels = {}
@@ -175,6 +299,7 @@ def get_type_constraints_help(type_obj):
     
     return " | ".join(constraints) if constraints else ""
 
+@memoize_per_component
 def get_documentation(obj):
     """Extract documentation from an XSD component."""
     docs = []
@@ -200,12 +325,131 @@ def get_documentation(obj):
         
     return docs
 
+@memoize_per_component
+def precompile_field(element, type_obj, metadata):
+    """
+    Precomputes everything about a simple-typed field that does not depend on the
+    entered values or the configuration: enums, labels, help text and CSV metadata.
+    """
+    is_mandatory = getattr(element, 'min_occurs', 1) >= 1
+
+    # Check for List Type (e.g. whitespace separated values)
+    is_list_type = getattr(type_obj, 'is_list', lambda: False)()
+
+    enums = get_enums_for_type(type_obj)
+    enum_labels = {}
+    # If it is a list type, try to get enums from the item type
+    if not enums and is_list_type and hasattr(type_obj, 'item_type'):
+         enums = get_enums_for_type(type_obj.item_type)
+         if enums:
+             enum_labels = get_enum_labels(type_obj.item_type)
+    elif enums:
+         enum_labels = get_enum_labels(type_obj)
+
+    # Handle optional Enum: Add empty option if not mandatory
+    if enums and not is_list_type and not is_mandatory:
+        if "" not in enums:
+            enums = ("",) + enums
+
+    # Build help text with documentation
+    help_lines = []
+    
+    # 1. Try element annotation
+    element_docs = get_documentation(element)
+    if element_docs:
+        help_lines.extend(element_docs)
+    
+    # 2. Try type annotation if element has none
+    if not element_docs:
+        type_docs = get_documentation(type_obj)
+        if type_docs:
+            help_lines.extend(type_docs)
+
+    # Extract FLD codes
+    temp_help_text = "\n".join(help_lines)
+    fld_codes = re.findall(r"#(FLD.*?)#", temp_help_text)
+    
+    # Fetch Metadata
+    meta_info = {}
+    if metadata and fld_codes:
+        for code in fld_codes:
+            if code in metadata:
+                row = metadata[code]
+                meta_info[code] = row
+                # Append info to help lines
+                help_lines.append(f"--- Metadata for {code} ---")
+                if row.get('Field Label'):
+                    help_lines.append(f"Label: {row['Field Label']}")
+                if row.get('Field Description / Notes'):
+                    help_lines.append(f"Description: {row['Field Description / Notes']}")
+                if row.get('Business Rules'):
+                    help_lines.append(f"Rules: {row['Business Rules']}")
+    
+    help_lines.append(f"Namespace: {element.name}")
+    
+    constraint_text = get_type_constraints_help(type_obj)
+    if constraint_text:
+        help_lines.append(f"Constraints: {constraint_text}")
+
+    # Check for max length for the input widget
+    max_chars = None
+    if hasattr(type_obj, 'max_length') and type_obj.max_length is not None:
+        max_chars = int(type_obj.max_length)
+
+    # XSD Occurrences
+    min_o = getattr(element, 'min_occurs', '1')
+    max_o = getattr(element, 'max_occurs', '1')
+    if max_o is None: max_o = "unbounded"
+
+    # Aggregate all metadata columns
+    # We want to check ALL headers that might exist in the collected rows
+    meta_columns = {}
+    if meta_info:
+        # Collect all column names found in the matched rows
+        found_keys = set()
+        for row in meta_info.values():
+            found_keys.update(row.keys())
+        
+        for key in found_keys:
+            if key is None: continue # Skip 'restkey' or unmatched columns
+            
+            values = []
+            # The fld_codes list determines which rows are relevant.
+            for code in fld_codes:
+                if code in meta_info:
+                    val_part = meta_info[code].get(key, '')
+                    if val_part: 
+                        if isinstance(val_part, list):
+                            values.append(",".join(map(str, val_part)))
+                        else:
+                            values.append(str(val_part))
+            
+            if values:
+                # Join multiple values with semi-colon
+                # Let's keep all to see distribution
+                meta_columns[key] = "; ".join(values)
+
+    return {
+        'is_mandatory': is_mandatory,
+        'is_list_type': is_list_type,
+        'is_boolean': bool(hasattr(type_obj, 'primitive_type') and type_obj.primitive_type
+                           and type_obj.primitive_type.local_name == 'boolean'),
+        'enums': enums,
+        'enum_labels': enum_labels,
+        'label': f"{element.local_name}",
+        'help_text': "\n\n".join(help_lines),
+        'max_chars': max_chars,
+        'fld_code_str': ", ".join(fld_codes) if fld_codes else "",
+        'xsd_min': str(min_o),
+        'xsd_max': str(max_o),
+        'meta_columns': meta_columns
+    }
+
 def render_input_fields(element, type_obj, parent_key, state_container, xml_path="", config_defaults=None, metadata=None, path_override=None, force_visible=False):
     """
     Recursively renders input fields for an element.
     Returns the value entered/selected by the user.
     """
-    indent_level = len(parent_key.split(".")) if parent_key else 0
     # Use clean name for key generation to avoid duplicates or weird keys
     elem_name_clean = element.name
 
@@ -218,14 +462,10 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
         current_path = path_override
     else:
         current_path = f"{xml_path}/{element.local_name}" if xml_path else element.local_name
-    
-    # Store the structure in session state to rebuild XML later
-    if 'xml_structure' not in state_container:
-        state_container['xml_structure'] = {}
 
     if type_obj.is_simple():
-        # Configuration Visibility Check
-        is_mandatory = getattr(element, 'min_occurs', 1) >= 1
+        field = precompile_field(element, type_obj, metadata)
+        is_mandatory = field['is_mandatory']
         
         # Handle indexed paths (e.g., path/to/elem[0])
         clean_path_for_check = re.sub(r'\[\d+\]', '', current_path)
@@ -254,71 +494,15 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
             # We skip it. Validation will catch it later if it was critical.
             return None
 
-        # Check for List Type (e.g. whitespace separated values)
-        is_list_type = getattr(type_obj, 'is_list', lambda: False)()
-
-        enums = get_enums_for_type(type_obj)
-        enum_labels = {}
-        # If it is a list type, try to get enums from the item type
-        if not enums and is_list_type and hasattr(type_obj, 'item_type'):
-             enums = get_enums_for_type(type_obj.item_type)
-             if enums:
-                 enum_labels = get_enum_labels(type_obj.item_type)
-        elif enums:
-             enum_labels = get_enum_labels(type_obj)
-
-        # Handle optional Enum: Add empty option if not mandatory
-        if enums and not is_list_type and not is_mandatory:
-            if "" not in enums:
-                enums = [""] + enums
-
-        label = f"{element.local_name}"
+        is_list_type = field['is_list_type']
+        enums = field['enums']
+        enum_labels = field['enum_labels']
+        label = field['label']
+        help_text = field['help_text']
         
         # Display XML Path
         st.caption(f"📍 Path: `{current_path}`")
         
-        # Build help text with documentation
-        help_lines = []
-        
-        # 1. Try element annotation
-        element_docs = get_documentation(element)
-        if element_docs:
-            help_lines.extend(element_docs)
-        
-        # 2. Try type annotation if element has none
-        if not element_docs:
-            type_docs = get_documentation(type_obj)
-            if type_docs:
-                help_lines.extend(type_docs)
-
-        # Extract FLD codes
-        temp_help_text = "\n".join(help_lines)
-        fld_codes = re.findall(r"#(FLD.*?)#", temp_help_text)
-        
-        # Fetch Metadata
-        meta_info = {}
-        if metadata and fld_codes:
-            for code in fld_codes:
-                if code in metadata:
-                    row = metadata[code]
-                    meta_info[code] = row
-                    # Append info to help lines
-                    help_lines.append(f"--- Metadata for {code} ---")
-                    if row.get('Field Label'):
-                        help_lines.append(f"Label: {row['Field Label']}")
-                    if row.get('Field Description / Notes'):
-                        help_lines.append(f"Description: {row['Field Description / Notes']}")
-                    if row.get('Business Rules'):
-                        help_lines.append(f"Rules: {row['Business Rules']}")
-        
-        help_lines.append(f"Namespace: {element.name}")
-        
-        constraint_text = get_type_constraints_help(type_obj)
-        if constraint_text:
-            help_lines.append(f"Constraints: {constraint_text}")
-            
-        help_text = "\n\n".join(help_lines)
-        
         val = None
         if enums:
             if is_list_type:
@@ -346,7 +530,7 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                 # If empty string selected/defaulted, return None so it is omitted from XML
                 if val == "":
                     val = None
-        elif hasattr(type_obj, 'primitive_type') and type_obj.primitive_type and type_obj.primitive_type.local_name == 'boolean':
+        elif field['is_boolean']:
              # Handle Boolean
              # Default value check
              is_checked = False
@@ -359,15 +543,10 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
              bool_val = st.toggle(label, value=is_checked, key=key, help=help_text)
              val = "true" if bool_val else "false"
         else:
-            # Check for max length for the input widget
-            max_chars = None
-            if hasattr(type_obj, 'max_length') and type_obj.max_length is not None:
-                max_chars = int(type_obj.max_length)
-             
             # Default value
             input_val = str(default_val) if default_val is not None else ""
                 
-            val = st.text_input(label, value=input_val, key=key, help=help_text, max_chars=max_chars)
+            val = st.text_input(label, value=input_val, key=key, help=help_text, max_chars=field['max_chars'])
         
         # Validation Logic
         if val:
@@ -378,14 +557,6 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                 st.error(f"❌ Invalid format: {e.reason}")
             except Exception as e:
                 st.error(f"❌ Invalid value")
-            
-            # Record data for CSV Export
-            fld_code_str = ", ".join(fld_codes) if fld_codes else ""
-            
-            # XSD Occurrences
-            min_o = getattr(element, 'min_occurs', '1')
-            max_o = getattr(element, 'max_occurs', '1')
-            if max_o is None: max_o = "unbounded"
 
             # Resolve enum label for display
             value_label = enum_labels.get(val, '') if enum_labels else ''
@@ -399,41 +570,13 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                 'XMLPath': current_path,
                 'value': val,
                 'value_label': value_label,
-                'xsd_min': str(min_o),
-                'xsd_max': str(max_o),
-                'FLD_code': fld_code_str,
+                'xsd_min': field['xsd_min'],
+                'xsd_max': field['xsd_max'],
+                'FLD_code': field['fld_code_str'],
                 'tooltip': help_text
             }
-            
-            # Aggregate all metadata columns
-            # We want to check ALL headers that might exist in the collected rows
-            if meta_info:
-                # Collect all column names found in the matched rows
-                found_keys = set()
-                for row in meta_info.values():
-                    found_keys.update(row.keys())
-                
-                for key in found_keys:
-                    if key is None: continue # Skip 'restkey' or unmatched columns
-                    
-                    values = []
-                    # We iterate over fld_codes to preserve some order or logic?
-                    # Or just iterate over meta_info items?
-                    # The fld_codes list determines which rows are relevant.
-                    for code in fld_codes:
-                        if code in meta_info:
-                            val_part = meta_info[code].get(key, '')
-                            if val_part: 
-                                if isinstance(val_part, list):
-                                    values.append(",".join(map(str, val_part)))
-                                else:
-                                    values.append(str(val_part))
-                    
-                    if values:
-                        # Join multiple values with semi-colon
-                        # Avoid duplicating if same value exists? 
-                        # Let's keep all to see distribution
-                        csv_entry[key] = "; ".join(values)
+            # Aggregated metadata columns
+            csv_entry.update(field['meta_columns'])
             
             if 'csv_entries' not in state_container:
                 state_container['csv_entries'] = []
@@ -464,20 +607,11 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
         # Handle abstract types - resolve to concrete derived type
         effective_type = type_obj
         if getattr(type_obj, 'abstract', False):
-            derived_types = []
-            if schema and hasattr(schema, 'maps') and schema.maps:
-                for tname, tdef in schema.maps.types.items():
-                    if (hasattr(tdef, 'base_type') and tdef.base_type is type_obj
-                         and not getattr(tdef, 'abstract', False)):
-                        derived_types.append(tdef)
+            derived_types = get_derived_types(type_obj)
 
             if derived_types:
                 # Get base type field names to identify extension-only fields
-                base_fields = set()
-                if type_obj.content:
-                    for p in type_obj.content.iter_model():
-                        if isinstance(p, xmlschema.validators.XsdElement):
-                            base_fields.add(p.local_name)
+                base_fields = set(get_element_names(type_obj.content)) if type_obj.content else set()
 
                 # Auto-detect concrete type from config by checking extension-only fields
                 selected_derived = None
@@ -486,9 +620,9 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                     for dt in derived_types:
                         match_count = 0
                         if dt.content:
-                            for p in dt.content.iter_model():
-                                if isinstance(p, xmlschema.validators.XsdElement) and p.local_name not in base_fields:
-                                    test_path = f"{current_path}/{p.local_name}"
+                            for name in get_element_names(dt.content):
+                                if name not in base_fields:
+                                    test_path = f"{current_path}/{name}"
                                     clean_test = re.sub(r'\[\d+\]', '', test_path)
                                     if test_path in config_defaults or clean_test in config_defaults:
                                         match_count += 1
@@ -526,11 +660,11 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
              # If it's a Choice with minOccurs >= 1, we must force a made selection
              if group_particle.model == 'choice' and group_particle.min_occurs >= 1:
                  # Get options
-                 options = [p for p in group_particle.iter_model()]
+                 options = get_model_particles(group_particle)
                  # Create labels for options (using local_name if element, else 'Group')
                  option_labels = []
                  for opt in options:
-                     if isinstance(opt, xmlschema.validators.XsdElement):
+                     if isinstance(opt, XsdElement):
                          option_labels.append(opt.local_name)
                      else:
                          option_labels.append("Nested Group") # Simplified for now
@@ -545,7 +679,7 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                  if cd:
                      visible_candidates = []
                      for idx, opt in enumerate(options):
-                         if isinstance(opt, xmlschema.validators.XsdElement):
+                         if isinstance(opt, XsdElement):
                              opt_path = f"{current_path}/{opt.local_name}"
                              
                              # Check precise match or if it's a prefix for other visible fields
@@ -575,7 +709,7 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                      selected_label = st.radio("Select type:", option_labels, index=default_idx, key=choice_key, horizontal=True, label_visibility="collapsed")
                      
                      for opt in options:
-                         if isinstance(opt, xmlschema.validators.XsdElement) and opt.local_name == selected_label:
+                         if isinstance(opt, XsdElement) and opt.local_name == selected_label:
                              selected_particle = opt
                              break
                  else:
@@ -588,7 +722,7 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                  if selected_particle is not None:
                       # Process the selected branch
                       
-                      if isinstance(selected_particle, xmlschema.validators.XsdElement):
+                      if isinstance(selected_particle, XsdElement):
                            if forced_choice:
                                 # Using standard layout but forcing visibility
                                 # Explicitly calling render_input_fields
@@ -628,8 +762,8 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
              
              # If Sequence or Optional Choice (though optional choice usually doesn't force input)
              else:
-                 for particle in group_particle.iter_model():
-                     if isinstance(particle, xmlschema.validators.XsdElement):
+                 for particle in get_model_particles(group_particle):
+                     if isinstance(particle, XsdElement):
                          # Determine visibility: Mandatory OR Configured (Visible/Default)
                          clean_path = f"{current_path}/{particle.local_name}" if current_path else particle.local_name
                          child_path = clean_path # default to clean path for check
@@ -744,7 +878,7 @@ def render_input_fields(element, type_obj, parent_key, state_container, xml_path
                                             # Store with qualified name
                                             group_data[particle.name] = child_val
                      
-                     elif isinstance(particle, xmlschema.validators.XsdGroup):
+                     elif isinstance(particle, XsdGroup):
                          if particle.min_occurs >= 1:
                              # Recurse for nested group
                              nested_data = process_group(particle, parent_key, current_path, indent_level, cd, md)
@@ -785,26 +919,64 @@ def build_xml_element(element_name, xsd_type, form_data):
             if isinstance(child_val, list):
                 for item in child_val:
                     if isinstance(item, (str, dict)):
-                         child_elem = build_xml_element_manual_tag(child_tag, item)
-                         elem.append(child_elem)
+                         build_xml_element_manual_tag(elem, child_tag, item)
             elif isinstance(child_val, (str, dict)):
-                child_elem = build_xml_element_manual_tag(child_tag, child_val)
-                elem.append(child_elem)
+                build_xml_element_manual_tag(elem, child_tag, child_val)
     
     elif isinstance(form_data, str):
         elem.text = form_data
         
     return elem
 
-def build_xml_element_manual_tag(tag, content):
-    elem = ET.Element(tag)
+@st.cache_resource
+def get_qname_cache():
+    """Process-wide store of lxml QName objects per '{uri}local' tag string."""
+    return {}
+
+qname_cache = get_qname_cache()
+
+def get_qname(tag):
+    """Returns the cached QName for a tag, so each distinct tag string is split and checked once."""
+    qname = qname_cache.get(tag)
+    if qname is None:
+        qname = qname_cache[tag] = ET.QName(tag)
+    return qname
+
+def build_xml_element_manual_tag(parent, tag, content):
+    """
+    Creates `tag` as a SubElement of `parent` and fills it from the form data.
+    Children are created in place so they stay in the parent's document.
+    """
+    elem = create_xml_child(parent, tag, content)
+    if isinstance(content, dict):
+        append_xml_children(elem, content)
+    return elem
+
+def create_xml_child(parent, tag, content):
+    """Creates a single SubElement: text for leaf values, xsi:type for abstract-type dicts."""
+    elem = ET.SubElement(parent, get_qname(tag))
     if isinstance(content, dict):
         # Handle xsi:type for abstract types (e.g. ClinicalSizeType -> RangeClinicalSizeType)
         xsi_type = content.get('__xsi_type__')
         if xsi_type:
             elem.set(f"{{{namespaces['xsi']}}}type", xsi_type)
+    else:
+        try:
+            elem.text = str(content)
+        except ValueError as e:
+            # lxml rejects control characters/NUL that XML can't carry; name the field
+            raise ValueError(f"{elem.getroottree().getpath(elem)}: {e}") from None
+    return elem
 
-        for child_tag, child_val in content.items():
+def append_xml_children(elem, content):
+    """
+    Adds the children described by the form data dict under `elem`.
+    Nested dicts are walked with an explicit stack instead of recursion.
+    """
+    stack = [(elem, content)]
+    while stack:
+        parent, data = stack.pop()
+        for child_tag, child_val in data.items():
             if child_val is None or child_tag == '__xsi_type__': continue
             
             # Determine namespace for child_tag if not present
@@ -813,32 +985,14 @@ def build_xml_element_manual_tag(tag, content):
             # If child_tag is already qualified {uri}name, leave it.
             if not child_tag.startswith('{'):
                 # Try to map based on known field names
-                if child_tag in ['riskClass', 'model', 'humanTissuesCells', 'animalTissuesCells', 
-                                 'humanProductCheck', 'IIb_implantable_exceptions', 'medicinalProductCheck',
-                                 'type', 'MFActorCode', 'deviceCertificateLinks']:
-                     final_tag = f"{{{namespaces['basicudi']}}}{child_tag}"
-                elif child_tag in ['identifier', 'status', 'basicUDIIdentifier', 'MDNCodes', 
-                                   'productionIdentifier', 'referenceNumber', 'sterile', 'sterilization',
-                                   'numberOfReuses', 'marketInfos', 'baseQuantity', 'latex', 'reprocessed']:
-                     final_tag = f"{{{namespaces['udidi']}}}{child_tag}"
-                elif child_tag in ['DICode', 'issuingEntityCode', 'active', 'administeringMedicine', 
-                                   'implantable', 'measuringFunction', 'reusable', 'code']:
-                     final_tag = f"{{{namespaces['commondi']}}}{child_tag}"
-                elif child_tag in ['deviceCertificateLink', 'certificateNumber', 'NBActorCode', 'certificateType']:
-                     final_tag = f"{{{namespaces['links']}}}{child_tag}"
-                elif child_tag in ['marketInfo', 'country', 'originalPlacedOnTheMarket']:
-                     final_tag = f"{{{namespaces['marketinfo']}}}{child_tag}"
+                final_tag = unqualified_tag_map.get(child_tag, child_tag)
             
-            if isinstance(child_val, list):
-                for item in child_val:
-                     child_elem = build_xml_element_manual_tag(final_tag, item)
-                     elem.append(child_elem)
-            else:
-                child_elem = build_xml_element_manual_tag(final_tag, child_val)
-                elem.append(child_elem)
-    else:
-        elem.text = str(content)
-    return elem
+            # Children are created in order here; only their own content is deferred
+            items = child_val if isinstance(child_val, list) else [child_val]
+            for item in items:
+                child_elem = create_xml_child(parent, final_tag, item)
+                if isinstance(item, dict):
+                    stack.append((child_elem, item))
 
 # --- Database Integration Functions ---
 
@@ -892,15 +1046,108 @@ def fetch_ifs_data(model, pcode):
         st.error(f"Error executing query: {e}")
         return None
 
+# --- Excel Export ---
+
+def build_excel_export(csv_entries, metadata_headers):
+    """Builds the Excel export of the entered field values and returns the .xlsx bytes."""
+    # Prepare Excel Data
+    excel_buffer = io.BytesIO()
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "EUDAMED Data"
+
+    # Define fields configuration
+    # Renaming map
+    rename_map = {
+        "Field applicable for MDR": "Field for MDR",
+        "Field applicable for IVDR": "Field for IVDR"
+    }
+
+    # Build columns definition list: [(DisplayHeader, DataKey)]
+    final_columns_def = []
+    
+    # 1. XMLPath (Fixed first column)
+    final_columns_def.append(('XMLPath', 'XMLPath'))
+    
+    # Check if "Occurrence" exists in metadata to determine placement
+    has_occurrence = "Occurrence" in metadata_headers
+    
+    # If "Occurrence" is NOT in metadata, we inject XSD cols early for visibility
+    if not has_occurrence:
+         final_columns_def.append( ("XSD MinOccurs", "xsd_min") )
+         final_columns_def.append( ("XSD MaxOccurs", "xsd_max") )
+    
+    # Standard fixed columns
+    final_columns_def.append(('value', 'value'))
+    final_columns_def.append(('Value Description', 'value_label'))
+    final_columns_def.append(('FLD_code', 'FLD_code'))
+    final_columns_def.append(('tooltip', 'tooltip'))
+
+    # Metadata columns (with dynamic injection if Occurrence exists)
+    for mh in metadata_headers:
+        display_name = rename_map.get(mh, mh)
+        final_columns_def.append( (display_name, mh) )
+        
+        if mh == "Occurrence":
+             final_columns_def.append( ("XSD MinOccurs", "xsd_min") )
+             final_columns_def.append( ("XSD MaxOccurs", "xsd_max") )
+
+    # Extract headers for Excel
+    headers = [c[0] for c in final_columns_def]
+    ws.append(headers)
+
+    # Write data
+    for entry in csv_entries:
+        row = []
+        for col_def in final_columns_def:
+            row.append(entry.get(col_def[1], ""))
+        ws.append(row)
+
+    # Create Table
+    last_col_letter = get_column_letter(len(headers))
+    last_row = ws.max_row
+    
+    if last_row > 1: # Only create table if data exists (row 1 is header)
+        tab = Table(displayName="EudamedData", ref=f"A1:{last_col_letter}{last_row}")
+        # Use TableStyleMedium16 (Blue-ish in some themes, or Neutral) as requested
+        # Disable column stripes ("Make columns not banded")
+        style = TableStyleInfo(name="TableStyleMedium16", showFirstColumn=False,
+                               showLastColumn=False, showRowStripes=True, showColumnStripes=False)
+        tab.tableStyleInfo = style
+        ws.add_table(tab)
+
+    # Apply Shrink to Fit
+    shrink_alignment = Alignment(shrink_to_fit=True, wrap_text=False)
+    for row in ws.iter_rows():
+        for cell in row:
+            cell.alignment = shrink_alignment
+            
+    # Set column widths based on header titles
+    for i, header in enumerate(headers, start=1):
+        col_letter = get_column_letter(i)
+        
+        if header == 'XMLPath': 
+            # Column A: Fixed width ~7.5 cm (approx 41 chars)
+            ws.column_dimensions[col_letter].width = 41
+        elif header == 'value':
+            # Column value: 2x wider than standard title fit
+            base_width = len(str(header)) + 5
+            ws.column_dimensions[col_letter].width = base_width * 2
+        elif header in ['XSD MinOccurs', 'XSD MaxOccurs']:
+            ws.column_dimensions[col_letter].width = 15
+        else:
+            # Other columns: Width based on header title length + padding
+            ws.column_dimensions[col_letter].width = len(str(header)) + 5
+
+    wb.save(excel_buffer)
+    return excel_buffer.getvalue()
+
 # --- Main App ---
 
-schema, error_msg = load_schema()
+# Build the schema in the background; the sidebar and settings below don't need it
+start_schema_load()
 metadata_csv, metadata_headers = load_eudamed_metadata()
 
-if not schema:
-    st.error(error_msg)
-    st.stop()
-
 # --- Logo & Configuration ---
 base_dir = os.path.dirname(os.path.abspath(__file__))
 logo_path = os.path.join(base_dir, '.streamlit', 'EUDAMED_logo.jpg')
@@ -969,8 +1216,27 @@ namespaces = {
     'marketinfo': 'https://ec.europa.eu/tools/eudamed/dtx/datamodel/Entity/MktInfo/MarketInfo/v1',
     'e': 'https://ec.europa.eu/tools/eudamed/dtx/datamodel/Entity/v1'
 }
-for prefix, uri in namespaces.items():
-    ET.register_namespace(prefix, uri)
+# Namespace map declared on generated roots (EUDAMED expects the Service namespace as 'ns2')
+xml_nsmap = {('ns2' if prefix == 's' else prefix): uri for prefix, uri in namespaces.items()}
+
+# Qualified tags for known field names that reach the XML builder without a {uri} prefix
+unqualified_tag_prefixes = {
+    'basicudi': ['riskClass', 'model', 'humanTissuesCells', 'animalTissuesCells', 
+                 'humanProductCheck', 'IIb_implantable_exceptions', 'medicinalProductCheck',
+                 'type', 'MFActorCode', 'deviceCertificateLinks'],
+    'udidi': ['identifier', 'status', 'basicUDIIdentifier', 'MDNCodes', 
+              'productionIdentifier', 'referenceNumber', 'sterile', 'sterilization',
+              'numberOfReuses', 'marketInfos', 'baseQuantity', 'latex', 'reprocessed'],
+    'commondi': ['DICode', 'issuingEntityCode', 'active', 'administeringMedicine', 
+                 'implantable', 'measuringFunction', 'reusable', 'code'],
+    'links': ['deviceCertificateLink', 'certificateNumber', 'NBActorCode', 'certificateType'],
+    'marketinfo': ['marketInfo', 'country', 'originalPlacedOnTheMarket']
+}
+unqualified_tag_map = {
+    tag: f"{{{namespaces[prefix]}}}{tag}"
+    for prefix, tags in unqualified_tag_prefixes.items()
+    for tag in tags
+}
 
 # Device Configuration Type Selection
 device_type_options = {
@@ -980,41 +1246,53 @@ device_type_options = {
     "Legacy IVD": "IVDEUDevice"
 }
 
+# Basic UDI and UDI-DI Data element names per root element
+device_part_names = {
+    "MDRDevice": ("MDRBasicUDI", "MDRUDIDIData"),
+    "MDEUDevice": ("MDEUDI", "MDEUData"),
+    "IVDRDevice": ("IVDRBasicUDI", "IVDRUDIDIData"),
+    "IVDEUDevice": ("IVDEUDI", "IVDEUData")
+}
+
 st.sidebar.markdown("---")
 # Default to MDR Device
 selected_device_type_label = st.sidebar.selectbox("Select Device Type", list(device_type_options.keys()))
 selected_root_element_name = device_type_options[selected_device_type_label]
 
-# Find root definition
-mdr_device_element = schema.elements.get(selected_root_element_name)
-if not mdr_device_element:
-    mdr_device_element = schema.elements.get(f"{{{namespaces['device']}}}{selected_root_element_name}")
+@st.cache_resource
+def load_device_definitions(_schema, root_element_name):
+    """
+    Resolve and cache the root device element with its Basic UDI and UDI-DI Data definitions.
+    Returns (root_element, basic_udi_def, udidi_data_def); missing parts are None.
+    """
+    # Device elements are declared in the imported Device namespace, not in Message.xsd,
+    # so only the global maps can resolve them (by qualified name)
+    root_element = _schema.maps.elements.get(f"{{{namespaces['device']}}}{root_element_name}")
 
-# Look in imported maps if not found in root elements
-if not mdr_device_element and hasattr(schema, 'maps') and schema.maps and schema.maps.elements:
-    mdr_device_element = schema.maps.elements.get(f"{{{namespaces['device']}}}{selected_root_element_name}")
+    if not root_element:
+        return None, None, None
 
+    # Index the device content model once by local name
+    particles = {
+        p.local_name: p for p in root_element.type.content.iter_model()
+        if isinstance(p, XsdElement)
+    }
+    basic_udi_name, udidi_data_name = device_part_names.get(root_element_name, (None, None))
 
-if not mdr_device_element:
-    st.error(f"Could not find {selected_root_element_name} element definition in schema.")
-    st.stop()
+    return root_element, particles.get(basic_udi_name), particles.get(udidi_data_name)
 
-mdr_device_type = mdr_device_element.type
-basic_udi_def = None
-udidi_data_def = None
+with st.spinner("Loading XSD schema..."):
+    schema, lxml_schema, error_msg = load_schema()
 
-# Logic to find the Basic UDI and UDI-DI Data parts based on naming conventions
-# MDR: MDRBasicUDI, MDRUDIDIData
-# Legacy: MDEUDI, MDEUData
-# IVDR: IVDRBasicUDI, IVDRUDIDIData
-# Legacy IVD: IVDEUDI, IVDEUData
+if not schema:
+    st.error(error_msg)
+    st.stop()
 
-for particle in mdr_device_type.content.iter_model():
-    name = particle.name
-    if 'BasicUDI' in name or 'EUDI' in name:
-        basic_udi_def = particle
-    elif 'UDIDIData' in name or 'EUData' in name:
-        udidi_data_def = particle
+mdr_device_element, basic_udi_def, udidi_data_def = load_device_definitions(schema, selected_root_element_name)
+
+if not mdr_device_element:
+    st.error(f"Could not find {selected_root_element_name} element definition in schema.")
+    st.stop()
 
 if not basic_udi_def or not udidi_data_def:
     st.error(f"Structure mismatch for {selected_root_element_name}: Could not find Basic UDI or Data definitions.")
@@ -1101,6 +1379,26 @@ if 'BasicUDI' in target_scope:
 else:
     basic_udi_data = None
 
+# Latest value and CSV rows per UDI-DI entry, written by the entry fragments
+udidi_entries = st.session_state.setdefault('udidi_entries', {})
+active_udidi_keys = []
+
+@st.fragment
+def render_udidi_entry(i, group_key_prefix, udidi_base_path):
+    """Renders one UDI-DI entry. Edits inside it rerun only this fragment, not the whole form."""
+    entry_container = {'csv_entries': []}
+    with st.expander(f"UDI-DI Entry #{i+1}", expanded=False):
+        udidi_data = render_input_fields(
+            udidi_data_def, 
+            udidi_data_def.type, 
+            group_key_prefix, 
+            entry_container, 
+            udidi_base_path,
+            config_defaults,
+            metadata_csv
+        )
+    udidi_entries[group_key_prefix] = {'data': udidi_data, 'csv_entries': entry_container['csv_entries']}
+
 if 'UDIDI' in target_scope:
     with st.expander("UDI-DI Data Entries", expanded=True):
         st.info("Fill in the mandatory fields for the UDI-DI. You can add multiple entries.")
@@ -1121,19 +1419,11 @@ if 'UDIDI' in target_scope:
         udidi_data_list = []
         udidi_base_path = f"Push/payload/{mdr_device_element.local_name}"
         for i in range(num_udis):
-            with st.expander(f"UDI-DI Entry #{i+1}", expanded=False):
-                # Pass unique parent key with group prefix
-                group_key_prefix = f"root_{selected_group}_{selected_root_element_name}.udidi_{i}"
-                udidi_data = render_input_fields(
-                    udidi_data_def, 
-                    udidi_data_def.type, 
-                    group_key_prefix, 
-                    data_collection_container, 
-                    udidi_base_path,
-                    config_defaults,
-                    metadata_csv
-                )
-                udidi_data_list.append(udidi_data)
+            # Pass unique parent key with group prefix
+            group_key_prefix = f"root_{selected_group}_{selected_root_element_name}.udidi_{i}"
+            render_udidi_entry(i, group_key_prefix, udidi_base_path)
+            active_udidi_keys.append(group_key_prefix)
+            udidi_data_list.append(udidi_entries[group_key_prefix]['data'])
 else:
     udidi_data_list = []
 
@@ -1172,102 +1462,17 @@ with col_gen:
     submitted = st.button("Generate XML", type="primary")
 
 with col_export:
-    # Prepare Excel Data
-    excel_buffer = io.BytesIO()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "EUDAMED Data"
-
-    # Define fields configuration
-    # Renaming map
-    rename_map = {
-        "Field applicable for MDR": "Field for MDR",
-        "Field applicable for IVDR": "Field for IVDR"
-    }
-
-    # Build columns definition list: [(DisplayHeader, DataKey)]
-    final_columns_def = []
-    
-    # 1. XMLPath (Fixed first column)
-    final_columns_def.append(('XMLPath', 'XMLPath'))
-    
-    # Check if "Occurrence" exists in metadata to determine placement
-    has_occurrence = "Occurrence" in metadata_headers
-    
-    # If "Occurrence" is NOT in metadata, we inject XSD cols early for visibility
-    if not has_occurrence:
-         final_columns_def.append( ("XSD MinOccurs", "xsd_min") )
-         final_columns_def.append( ("XSD MaxOccurs", "xsd_max") )
-    
-    # Standard fixed columns
-    final_columns_def.append(('value', 'value'))
-    final_columns_def.append(('Value Description', 'value_label'))
-    final_columns_def.append(('FLD_code', 'FLD_code'))
-    final_columns_def.append(('tooltip', 'tooltip'))
-
-    # Metadata columns (with dynamic injection if Occurrence exists)
-    for mh in metadata_headers:
-        display_name = rename_map.get(mh, mh)
-        final_columns_def.append( (display_name, mh) )
-        
-        if mh == "Occurrence":
-             final_columns_def.append( ("XSD MinOccurs", "xsd_min") )
-             final_columns_def.append( ("XSD MaxOccurs", "xsd_max") )
-
-    # Extract headers for Excel
-    headers = [c[0] for c in final_columns_def]
-    ws.append(headers)
-
-    # Write data
-    if 'csv_entries' in data_collection_container:
-        for entry in data_collection_container['csv_entries']:
-            row = []
-            for col_def in final_columns_def:
-                row.append(entry.get(col_def[1], ""))
-            ws.append(row)
-
-    # Create Table
-    last_col_letter = get_column_letter(len(headers))
-    last_row = ws.max_row
-    
-    if last_row > 1: # Only create table if data exists (row 1 is header)
-        tab = Table(displayName="EudamedData", ref=f"A1:{last_col_letter}{last_row}")
-        # Use TableStyleMedium16 (Blue-ish in some themes, or Neutral) as requested
-        # Disable column stripes ("Make columns not banded")
-        style = TableStyleInfo(name="TableStyleMedium16", showFirstColumn=False,
-                               showLastColumn=False, showRowStripes=True, showColumnStripes=False)
-        tab.tableStyleInfo = style
-        ws.add_table(tab)
-
-    # Apply Shrink to Fit
-    shrink_alignment = Alignment(shrink_to_fit=True, wrap_text=False)
-    for row in ws.iter_rows():
-        for cell in row:
-            cell.alignment = shrink_alignment
-            
-    # Set column widths based on header titles
-    for i, header in enumerate(headers, start=1):
-        col_letter = get_column_letter(i)
-        
-        if header == 'XMLPath': 
-            # Column A: Fixed width ~7.5 cm (approx 41 chars)
-            ws.column_dimensions[col_letter].width = 41
-        elif header == 'value':
-            # Column value: 2x wider than standard title fit
-            base_width = len(str(header)) + 5
-            ws.column_dimensions[col_letter].width = base_width * 2
-        elif header in ['XSD MinOccurs', 'XSD MaxOccurs']:
-            ws.column_dimensions[col_letter].width = 15
-        else:
-            # Other columns: Width based on header title length + padding
-            ws.column_dimensions[col_letter].width = len(str(header)) + 5
-
-    wb.save(excel_buffer)
-    excel_data = excel_buffer.getvalue()
+    def collect_csv_entries():
+        """Basic UDI entries of this run plus the latest entries stored by the UDI-DI fragments."""
+        entries = list(data_collection_container['csv_entries'])
+        for entry_key in active_udidi_keys:
+            entries.extend(udidi_entries[entry_key]['csv_entries'])
+        return entries
 
     st.download_button(
         label="Export Data to Excel",
-        data=excel_data,
+        # Built on click so edits rerun only inside a UDI-DI fragment are included
+        data=lambda: build_excel_export(collect_csv_entries(), metadata_headers),
         file_name="eudamed_data_export.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
@@ -1505,147 +1710,143 @@ if submitted:
         # Generate separate file for each block
         for block_idx, block in enumerate(payload_blocks):
         
-            # Root Payload for this file
-            payload_elements = [] 
+            try:
+                # Root Payload for this file
+                payload_elements = [] 
 
-            if block['type'] == 'DEVICE':
-                p_root = ET.Element(f"{{{namespaces['device']}}}Device")
-                type_name = clean_xsi_type_name(mdr_device_element.type.name)
-                set_xsi_type(p_root, type_name)
+                if block['type'] == 'DEVICE':
+                    p_root = ET.Element(f"{{{namespaces['device']}}}Device", nsmap=xml_nsmap)
+                    type_name = clean_xsi_type_name(mdr_device_element.type.name)
+                    set_xsi_type(p_root, type_name)
                 
-                # Add Basic UDI
-                if block['budi']:
-                    budi_name = clean_xsi_type_name(basic_udi_def.name)
-                    basic_udi_elem = build_xml_element_manual_tag(f"{{{namespaces['device']}}}{budi_name}", block['budi'])
-                    p_root.append(basic_udi_elem)
+                    # Add Basic UDI
+                    if block['budi']:
+                        budi_name = clean_xsi_type_name(basic_udi_def.name)
+                        build_xml_element_manual_tag(p_root, f"{{{namespaces['device']}}}{budi_name}", block['budi'])
                     
-                # Add UDI-DIs
-                for udi_data in block['udidis']:
-                    if udi_data:
-                         udidi_name = clean_xsi_type_name(udidi_data_def.name)
-                         udidi_elem = build_xml_element_manual_tag(f"{{{namespaces['device']}}}{udidi_name}", udi_data)
-                         p_root.append(udidi_elem)
+                    # Add UDI-DIs
+                    for udi_data in block['udidis']:
+                        if udi_data:
+                             udidi_name = clean_xsi_type_name(udidi_data_def.name)
+                             build_xml_element_manual_tag(p_root, f"{{{namespaces['device']}}}{udidi_name}", udi_data)
                 
-                payload_elements.append(p_root)
+                    payload_elements.append(p_root)
 
-            elif block['type'] == 'UDIDI_BULK':
-                # Generate multiple UDIDIData elements
-                type_name = udidi_data_def.type.name if hasattr(udidi_data_def.type, 'name') else "MDRUDIDIDataType"
+                elif block['type'] == 'UDIDI_BULK':
+                    # Generate multiple UDIDIData elements
+                    type_name = udidi_data_def.type.name if hasattr(udidi_data_def.type, 'name') else "MDRUDIDIDataType"
                 
-                for item in block['items']:
-                     p_root = ET.Element(f"{{{namespaces['device']}}}UDIDIData")
-                     set_xsi_type(p_root, f"udidi:{type_name}")
+                    for item in block['items']:
+                         p_root = ET.Element(f"{{{namespaces['device']}}}UDIDIData", nsmap=xml_nsmap)
+                         set_xsi_type(p_root, f"udidi:{type_name}")
                      
+                         if task['mode'] == 'PATCH':
+                             # Add Version for PATCH
+                             # Check availability of patch_version
+                             ver_val = str(patch_version) if 'patch_version' in locals() else "1"
+                             ver_elem = ET.Element(f"{{{namespaces['e']}}}version")
+                             ver_elem.text = ver_val
+                             p_root.insert(0, ver_elem)
+
+                         if isinstance(item, dict):
+                              append_xml_children(p_root, item)
+                     
+                         payload_elements.append(p_root)
+
+                elif block['type'] == 'BasicUDI':
+                     p_root = ET.Element(f"{{{namespaces['device']}}}BasicUDI", nsmap=xml_nsmap)
+                     type_name = basic_udi_def.type.name if hasattr(basic_udi_def.type, 'name') else "MDRBasicUDIType"
+                     set_xsi_type(p_root, f"device:{type_name}")
+                 
                      if task['mode'] == 'PATCH':
-                         # Add Version for PATCH
-                         # Check availability of patch_version
                          ver_val = str(patch_version) if 'patch_version' in locals() else "1"
                          ver_elem = ET.Element(f"{{{namespaces['e']}}}version")
                          ver_elem.text = ver_val
                          p_root.insert(0, ver_elem)
-
-                     temp_elem = build_xml_element_manual_tag("TEMP", item)
-                     for child in temp_elem:
-                          p_root.append(child)
-                     
-                     payload_elements.append(p_root)
-
-            elif block['type'] == 'BasicUDI':
-                 p_root = ET.Element(f"{{{namespaces['device']}}}BasicUDI")
-                 type_name = basic_udi_def.type.name if hasattr(basic_udi_def.type, 'name') else "MDRBasicUDIType"
-                 set_xsi_type(p_root, f"device:{type_name}")
                  
-                 if task['mode'] == 'PATCH':
-                     ver_val = str(patch_version) if 'patch_version' in locals() else "1"
-                     ver_elem = ET.Element(f"{{{namespaces['e']}}}version")
-                     ver_elem.text = ver_val
-                     p_root.insert(0, ver_elem)
+                     if isinstance(block['data'], dict):
+                          append_xml_children(p_root, block['data'])
                  
-                 temp_elem = build_xml_element_manual_tag("TEMP", block['data'])
-                 for child in temp_elem:
-                      p_root.append(child)
-                 
-                 payload_elements.append(p_root)
+                     payload_elements.append(p_root)
 
-            if not payload_elements: continue
+                if not payload_elements: continue
 
-            # 3. Build Envelope
-            sec_token = ""
-            actor_code = ""
-            party_id = ""
-            if config_defaults:
-                actor_code = config_defaults.get('Push/sender/node/nodeActorCode', '')
-                sec_token = config_defaults.get('Push/header/security_token', '')
-                party_id = config_defaults.get('Push/header/party_id', '')
+                # 3. Build Envelope
+                sec_token = ""
+                actor_code = ""
+                party_id = ""
+                if config_defaults:
+                    actor_code = config_defaults.get('Push/sender/node/nodeActorCode', '')
+                    sec_token = config_defaults.get('Push/header/security_token', '')
+                    party_id = config_defaults.get('Push/header/party_id', '')
 
-            m_ns = f"{{{namespaces['m']}}}"
-            ns2_ns = f"{{{namespaces['s']}}}"
-            
-            root = ET.Element(f"{m_ns}Push")
+                m_ns = f"{{{namespaces['m']}}}"
+                ns2_ns = f"{{{namespaces['s']}}}"
             
-            root.set(f"{{{namespaces['xsi']}}}schemaLocation", 
-                     f"{namespaces['m']} https://webgate.ec.europa.eu/tools/eudamed/dtx/service/Message.xsd")
-            root.set("version", "3.0.25")
+                root = ET.Element(f"{m_ns}Push", nsmap=xml_nsmap)
             
-            corr_id = ET.SubElement(root, f"{m_ns}correlationID")
-            corr_id.text = str(uuid.uuid4())
+                root.set(f"{{{namespaces['xsi']}}}schemaLocation", 
+                         f"{namespaces['m']} https://webgate.ec.europa.eu/tools/eudamed/dtx/service/Message.xsd")
+                root.set("version", "3.0.25")
             
-            create_dt = ET.SubElement(root, f"{m_ns}creationDateTime")
-            create_dt.text = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+                corr_id = ET.SubElement(root, f"{m_ns}correlationID")
+                corr_id.text = str(uuid.uuid4())
             
-            msg_id = ET.SubElement(root, f"{m_ns}messageID")
-            msg_id.text = str(uuid.uuid4())
+                create_dt = ET.SubElement(root, f"{m_ns}creationDateTime")
+                create_dt.text = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
             
-            recipient = ET.SubElement(root, f"{m_ns}recipient")
-            node = ET.SubElement(recipient, f"{m_ns}node")
-            node_actor = ET.SubElement(node, f"{ns2_ns}nodeActorCode")
-            node_actor.text = "EUDAMED"
+                msg_id = ET.SubElement(root, f"{m_ns}messageID")
+                msg_id.text = str(uuid.uuid4())
             
-            service = ET.SubElement(recipient, f"{m_ns}service")
-            svc_id = ET.SubElement(service, f"{ns2_ns}serviceID")
-            svc_id.text = task['service_id']
-            svc_op = ET.SubElement(service, f"{ns2_ns}serviceOperation")
-            svc_op.text = task['mode']
+                recipient = ET.SubElement(root, f"{m_ns}recipient")
+                node = ET.SubElement(recipient, f"{m_ns}node")
+                node_actor = ET.SubElement(node, f"{ns2_ns}nodeActorCode")
+                node_actor.text = "EUDAMED"
             
-            # <m:payload>
-            payload = ET.SubElement(root, f"{m_ns}payload")
-            # Append all elements for this block
-            for pe in payload_elements:
-                payload.append(pe)
+                service = ET.SubElement(recipient, f"{m_ns}service")
+                svc_id = ET.SubElement(service, f"{ns2_ns}serviceID")
+                svc_id.text = task['service_id']
+                svc_op = ET.SubElement(service, f"{ns2_ns}serviceOperation")
+                svc_op.text = task['mode']
             
-            sender = ET.SubElement(root, f"{m_ns}sender")
-            s_node = ET.SubElement(sender, f"{m_ns}node")
-            s_node_actor = ET.SubElement(s_node, f"{ns2_ns}nodeActorCode")
-            s_node_actor.text = actor_code
+                # <m:payload>
+                payload = ET.SubElement(root, f"{m_ns}payload")
+                # Append all elements for this block
+                for pe in payload_elements:
+                    payload.append(pe)
             
-            s_service = ET.SubElement(sender, f"{m_ns}service")
-            s_site_id = ET.SubElement(s_service, f"{ns2_ns}serviceID")
-            s_site_id.text = task['service_id']
-            s_svc_op = ET.SubElement(s_service, f"{ns2_ns}serviceOperation")
-            s_svc_op.text = task['mode']
-
-            rough_string = ET.tostring(root, encoding="utf-8")
-            reparsed = xml.dom.minidom.parseString(rough_string)
-            final_xml = reparsed.toprettyxml(indent="  ", encoding="utf-8").decode("utf-8")
+                sender = ET.SubElement(root, f"{m_ns}sender")
+                s_node = ET.SubElement(sender, f"{m_ns}node")
+                s_node_actor = ET.SubElement(s_node, f"{ns2_ns}nodeActorCode")
+                s_node_actor.text = actor_code
             
-            final_xml = final_xml.replace('xmlns:s=', 'xmlns:ns2=')
-            final_xml = final_xml.replace('<s:', '<ns2:')
-            final_xml = final_xml.replace('</s:', '</ns2:')
-
-            final_xml = re.sub(r'\n\s*\n', '\n', final_xml)
+                s_service = ET.SubElement(sender, f"{m_ns}service")
+                s_site_id = ET.SubElement(s_service, f"{ns2_ns}serviceID")
+                s_site_id.text = task['service_id']
+                s_svc_op = ET.SubElement(s_service, f"{ns2_ns}serviceOperation")
+                s_svc_op.text = task['mode']
+            except ValueError as e:
+                # A value that XML can't represent (e.g. a pasted control character) skips this file only
+                st.error(f"Could not build {task['service_id']} {task['mode']} ({block['type']}): {e}")
+                continue
+
+            # Serialized once; the bytes feed the downloads and the ZIP, only the preview is decoded
+            xml_bytes = ET.tostring(root, pretty_print=True, xml_declaration=True, encoding="utf-8")
 
             validation_status = "Unknown"
             validation_details = ""
             try:
-                if schema.is_valid(final_xml):
+                # Validate the in-memory tree directly with libxml2 (no re-parse of the serialized text);
+                # the validator is shared by all sessions, so read its error_log under the same lock
+                with get_validation_lock():
+                    is_valid = lxml_schema.validate(root)
+                    errors = [f"{err.path}: {err.message}" for err in lxml_schema.error_log]
+                if is_valid:
                     validation_status = "Valid"
                     validation_details = "✅ XML is valid against the schema."
                 else:
                     validation_status = "Invalid"
-                    try:
-                        schema.validate(final_xml)
-                    except Exception as e:
-                        validation_details = f"❌ Validation Error: {e}"
+                    validation_details = "❌ Validation Error:\n\n" + "\n\n".join(errors)
             except Exception as e:
                  validation_status = "Error"
                  validation_details = f"⚠️ Validation Process Failed: {e}"
@@ -1673,13 +1874,16 @@ if submitted:
             
             created_files.append({
                 'name': fname, 
-                'content': final_xml, 
+                'data': xml_bytes,
                 'label': f"{task['service_id']} {task['mode']} ({block['type']})",
                 'validation_status': validation_status,
                 'validation_details': validation_details
             })
 
     st.subheader("Generated XML Files")
+
+    # Larger messages are only previewed partially to keep the page light; downloads are complete
+    preview_limit = 100 * 1024
     
     for cfile in created_files:
         with st.expander(f"{cfile['name']} ({cfile['validation_status']})", expanded=False):
@@ -1690,10 +1894,13 @@ if submitted:
              else:
                  st.warning(cfile['validation_details'])
                  
-             st.code(cfile['content'], language="xml")
+             # errors="ignore" drops a multi-byte character cut at the preview limit
+             st.code(cfile['data'][:preview_limit].decode("utf-8", errors="ignore"), language="xml")
+             if len(cfile['data']) > preview_limit:
+                 st.caption(f"Preview shows the first {preview_limit // 1024} KB of {len(cfile['data']) // 1024} KB; download the file for the full XML.")
              st.download_button(
                 label=f"Download {cfile['name']}",
-                data=cfile['content'],
+                data=cfile['data'],
                 file_name=cfile['name'],
                 mime="application/xml",
                 key=cfile['name']
@@ -1706,7 +1913,7 @@ if submitted:
              zip_buffer = io.BytesIO()
              with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
                  for cfile in created_files:
-                     zip_file.writestr(cfile['name'], cfile['content'])
+                     zip_file.writestr(cfile['name'], cfile['data'])
              
              st.download_button(
                  label="Download All XMLs (ZIP)",